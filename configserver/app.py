@@ -6,14 +6,45 @@ Extracts username from Google OAuth email and auto-provisions users
 """
 
 import os
+import atexit
+import hashlib
 import json
 import logging
-import subprocess
+import logging.handlers
+import queue
+import shlex
 import re
-from flask import Flask, request, jsonify
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import orjson
+from cachetools import TTLCache
+from flask import Flask, request
+from flask_caching import Cache
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.DEBUG)
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 30})
+# Log records are handed to a background listener through an in-memory
+# queue, so the request path pays a queue.put instead of a stderr write.
+# basicConfig puts its formatter on the QueueHandler, which bakes the
+# formatted message into the record before it is queued, so the listener's
+# StreamHandler must not format again.
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler())
+_LOG_LISTENER.start()
+# Drain queued records on interpreter shutdown so worker exits aren't silent
+atexit.register(_LOG_LISTENER.stop)
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    handlers=[logging.handlers.QueueHandler(_LOG_QUEUE)],
+)
 logger = logging.getLogger(__name__)
 
 # Paths
@@ -22,16 +53,168 @@ USERS_MAP_FILE = os.path.join(DATA_DIR, "users_map.json")
 SERVICE_KEY = "/etc/containerssh/keys/backend_id_ed25519"
 SERVICE_KEY_PUB = "/etc/containerssh/keys/backend_id_ed25519.pub"
 
+# Routing prefixes compiled into one alternation so a single C-level match
+# replaces the chain of startswith calls on every request
+_ROUTE_RE = re.compile(r"^(?:(?P<vm1>admin|ops)|(?P<vm2>dev|test))")
+
+# Username sanitizer: anything outside [a-zA-Z0-9._-] becomes "_". The
+# translation table handles ASCII input in one C-level pass; the compiled
+# regex covers the rare non-ASCII email
+_SANITIZE_RE = re.compile(r"[^a-zA-Z0-9._-]")
+_SANITIZE_TABLE = str.maketrans(
+    {chr(i): "_" for i in range(128) if _SANITIZE_RE.match(chr(i))}
+)
+
+
+# Cache for the users map, keyed on (mtime_ns, size) of the file so the
+# JSON is only re-read and re-parsed when the file actually changes. "index"
+# is the flattened read-only view served to the request hot path.
+_EMPTY_INDEX = types.MappingProxyType({})
+_USERS_CACHE = {"mtime": None, "size": None, "data": {}, "index": _EMPTY_INDEX}
+_USERS_CACHE_LOCK = threading.Lock()
+
+
+# Set once the inotify watcher is running; steady-state requests then read
+# the cache directly without even a stat syscall
+_WATCHER = {"active": False}
+
 
 def load_users_map():
-    """Load user-to-backend mapping from JSON file"""
-    if os.path.exists(USERS_MAP_FILE):
+    """Load user-to-backend mapping from JSON file (cached until the file changes)"""
+    if _WATCHER["active"]:
+        # The watcher keeps the cache fresh, no per-request stat needed
+        return _USERS_CACHE["data"]
+    return _read_users_map_from_disk()
+
+
+def _read_users_map_from_disk():
+    """Stat the users map and re-read it if it changed since the last load"""
+    try:
+        st = os.stat(USERS_MAP_FILE)
+    except FileNotFoundError:
+        return {}
+
+    with _USERS_CACHE_LOCK:
+        if (st.st_mtime_ns, st.st_size) == (
+            _USERS_CACHE["mtime"],
+            _USERS_CACHE["size"],
+        ):
+            return _USERS_CACHE["data"]
+
         try:
-            with open(USERS_MAP_FILE, "r") as f:
-                return json.load(f)
+            with open(USERS_MAP_FILE, "rb") as f:
+                data = orjson.loads(f.read())
+            # Build the index before touching the cache so a shape error
+            # is handled like a parse error and never leaves the cache
+            # half-updated with a matching mtime but a stale index
+            index = _flatten_users_map(data)
         except Exception as e:
-            logger.error(f"Error loading users map: {e}")
-    return {}
+            logger.error("Error loading users map: %s", e)
+            return {}
+
+        _USERS_CACHE["mtime"] = st.st_mtime_ns
+        _USERS_CACHE["size"] = st.st_size
+        _USERS_CACHE["data"] = data
+        _USERS_CACHE["index"] = index
+        # Cached responses were computed against the old map
+        cache.clear()
+        return data
+
+
+def _flatten_users_map(raw):
+    """Flatten the users map into read-only (backend, port, key blobs) tuples"""
+    return types.MappingProxyType(
+        {
+            user: (
+                cfg.get("backend", "vm1"),
+                cfg.get("port", 22),
+                authorized_key_blobs(cfg),
+            )
+            for user, cfg in raw.items()
+        }
+    )
+
+
+def load_users_index():
+    """
+    Flattened view of the users map for the request hot path. Served from
+    the cache when current; rebuilt only if load_users_map returned a map
+    the cache has not seen (e.g. when stubbed out in tests).
+    """
+    raw = load_users_map()
+    if raw is _USERS_CACHE["data"]:
+        return _USERS_CACHE["index"]
+    return _flatten_users_map(raw)
+
+
+def _watch_users_map(inotify):
+    """Reload the users map whenever inotify reports a write to it"""
+    target = os.path.basename(USERS_MAP_FILE)
+    try:
+        while True:
+            for event in inotify.read():
+                if event.name != target:
+                    continue
+                try:
+                    if event.mask & inotify_flags.DELETE:
+                        with _USERS_CACHE_LOCK:
+                            _USERS_CACHE.update(
+                                {
+                                    "mtime": None,
+                                    "size": None,
+                                    "data": {},
+                                    "index": _EMPTY_INDEX,
+                                }
+                            )
+                            cache.clear()
+                    else:
+                        _read_users_map_from_disk()
+                except Exception as e:
+                    logger.error("Error reloading users map from watcher: %s", e)
+    finally:
+        # If the watcher dies for any reason, requests must fall back to
+        # the per-request stat path rather than serve a stale map forever
+        _WATCHER["active"] = False
+        logger.error("users_map watcher stopped; falling back to stat-per-request")
+
+
+def start_users_map_watcher():
+    """Start the inotify watcher thread; fall back to per-request stat if unavailable"""
+    if INotify is None:
+        return
+    try:
+        inotify = INotify()
+        inotify.add_watch(
+            DATA_DIR,
+            inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.DELETE,
+        )
+    except OSError as e:
+        logger.warning("users_map watcher disabled: %s", e)
+        return
+
+    # Prime the cache before requests start bypassing the stat check
+    _read_users_map_from_disk()
+    threading.Thread(
+        target=_watch_users_map, args=(inotify,), daemon=True, name="users-map-watcher"
+    ).start()
+    _WATCHER["active"] = True
+
+
+start_users_map_watcher()
+
+
+def make_cache_key():
+    """Cache key for response memoization: hash of request path and body"""
+    digest = hashlib.blake2b(request.path.encode(), digest_size=16)
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def json_response(data, status=200):
+    """Build a JSON response with orjson, bypassing jsonify's serializer"""
+    return app.response_class(
+        orjson.dumps(data), status=status, mimetype="application/json"
+    )
 
 
 def extract_username_from_email(email):
@@ -43,43 +226,97 @@ def extract_username_from_email(email):
       test+tag@example.com -> test+tag
     """
     if not email or "@" not in email:
-        logger.warning(f"Invalid email format: {email}")
+        logger.warning("Invalid email format: %s", email)
         return None
 
     username = email.split("@")[0]
 
     # Sanitize username for Unix compatibility
     # Replace any characters that aren't alphanumeric, dot, dash, or underscore
-    username = re.sub(r"[^a-zA-Z0-9._-]", "_", username)
+    if username.isascii():
+        username = username.translate(_SANITIZE_TABLE)
+    else:
+        username = _SANITIZE_RE.sub("_", username)
 
     # Ensure username doesn't start with a dash or dot
-    username = re.sub(r"^[-.]", "_", username)
+    if username and username[0] in "-.":
+        username = "_" + username[1:]
 
     # Truncate to 32 characters (Unix username limit)
     username = username[:32]
 
-    logger.info(f"Extracted username '{username}' from email '{email}'")
+    logger.info("Extracted username '%s' from email '%s'", username, email)
     return username
 
 
+# Persistent docker SDK client and per-VM container handles, created on
+# first use so importing the app never requires a reachable daemon
+_DOCKER_LOCK = threading.Lock()
+_DOCKER_STATE = {"client": None, "containers": {}}
+
+# Routing targets are service hostnames (vm1/vm2), but the docker API
+# resolves containers by name, so translate before exec'ing. The suffix
+# covers the *_test container names used by docker-compose.test.yml.
+_CONTAINER_NAMES = {"vm1": "backend_vm1", "vm2": "backend_vm2"}
+_CONTAINER_SUFFIX = os.environ.get("BACKEND_CONTAINER_SUFFIX", "")
+
+
+def get_backend_container(vm_hostname):
+    """Return a cached docker SDK handle for the backend VM container"""
+    name = _CONTAINER_NAMES.get(vm_hostname)
+    name = name + _CONTAINER_SUFFIX if name else vm_hostname
+    with _DOCKER_LOCK:
+        client = _DOCKER_STATE["client"]
+        if client is None:
+            client = docker.from_env(timeout=15)
+            _DOCKER_STATE["client"] = client
+        container = _DOCKER_STATE["containers"].get(name)
+        if container is None:
+            container = client.containers.get(name)
+            _DOCKER_STATE["containers"][name] = container
+        return container
+
+
+# Positive user-existence results, so repeat logins skip the docker exec.
+# Negative results are never cached: create_user_on_vm may have just run.
+_USER_EXISTS_CACHE = TTLCache(maxsize=10000, ttl=300)
+_USER_EXISTS_LOCK = threading.Lock()
+
+# The backend service public key never changes during the process lifetime
+_SERVICE_KEY_PUB_CACHE = {}
+
+
+def get_service_key_pub():
+    """Read the backend service public key, cached after the first read"""
+    key = _SERVICE_KEY_PUB_CACHE.get("key")
+    if key is None:
+        with open(SERVICE_KEY_PUB, "r") as f:
+            key = f.read().strip()
+        _SERVICE_KEY_PUB_CACHE["key"] = key
+    return key
+
+
 def user_exists_on_vm(vm_hostname, username):
     """
     Check if user exists on the backend VM
     Returns True if user exists, False otherwise
     """
+    cache_key = (vm_hostname, username)
+    with _USER_EXISTS_LOCK:
+        if cache_key in _USER_EXISTS_CACHE:
+            return True
+
     try:
-        # Use docker exec to check if user exists
-        result = subprocess.run(
-            ["docker", "exec", vm_hostname, "id", username],
-            capture_output=True,
-            text=True,
-            timeout=5,
-        )
-        exists = result.returncode == 0
-        logger.info(f"User '{username}' exists on {vm_hostname}: {exists}")
+        # Exec directly over the docker socket instead of spawning the CLI
+        result = get_backend_container(vm_hostname).exec_run(["id", username])
+        exists = result.exit_code == 0
+        if exists:
+            with _USER_EXISTS_LOCK:
+                _USER_EXISTS_CACHE[cache_key] = True
+        logger.info("User '%s' exists on %s: %s", username, vm_hostname, exists)
         return exists
     except Exception as e:
-        logger.error(f"Error checking if user exists on {vm_hostname}: {e}")
+        logger.error("Error checking if user exists on %s: %s", vm_hostname, e)
         return False
 
 
@@ -89,138 +326,95 @@ def create_user_on_vm(vm_hostname, username):
     Sets up home directory, .ssh folder, and authorized_keys with backend service key
     """
     try:
-        logger.info(f"Creating user '{username}' on {vm_hostname}")
-
-        # 1. Create user account
-        result = subprocess.run(
-            [
-                "docker",
-                "exec",
-                vm_hostname,
-                "useradd",
-                "-m",
-                "-s",
-                "/bin/bash",
-                username,
-            ],
-            capture_output=True,
-            text=True,
-            timeout=10,
-        )
-        if result.returncode != 0:
-            logger.error(f"Failed to create user: {result.stderr}")
+        logger.info("Creating user '%s' on %s", username, vm_hostname)
+
+        # Read backend service public key (cached after the first read)
+        try:
+            service_key_pub = get_service_key_pub()
+        except FileNotFoundError:
+            logger.error("Backend service key not found: %s", SERVICE_KEY_PUB)
             return False
 
-        # 2. Create .ssh directory
-        subprocess.run(
-            ["docker", "exec", vm_hostname, "mkdir", "-p", f"/home/{username}/.ssh"],
-            capture_output=True,
-            timeout=5,
+        # Run the whole provisioning sequence in a single container exec:
+        # one dockerd round-trip instead of six. The key goes through a
+        # quoted heredoc so it is never shell-interpreted.
+        user = shlex.quote(username)
+        script = (
+            "set -e\n"
+            f"useradd -m -s /bin/bash {user}\n"
+            f"mkdir -p /home/{user}/.ssh\n"
+            f"cat > /home/{user}/.ssh/authorized_keys <<'EOF'\n"
+            f"{service_key_pub}\n"
+            "EOF\n"
+            f"chown -R {user}:{user} /home/{user}/.ssh\n"
+            f"chmod 700 /home/{user}/.ssh\n"
+            f"chmod 600 /home/{user}/.ssh/authorized_keys\n"
         )
 
-        # 3. Read backend service public key
-        if not os.path.exists(SERVICE_KEY_PUB):
-            logger.error(f"Backend service key not found: {SERVICE_KEY_PUB}")
+        result = get_backend_container(vm_hostname).exec_run(["bash", "-c", script])
+        if result.exit_code != 0:
+            logger.error("Failed to create user: %s", result.output.decode())
             return False
 
-        with open(SERVICE_KEY_PUB, "r") as f:
-            service_key_pub = f.read().strip()
-
-        # 4. Add service key to authorized_keys
-        subprocess.run(
-            [
-                "docker",
-                "exec",
-                vm_hostname,
-                "bash",
-                "-c",
-                f"echo '{service_key_pub}' > /home/{username}/.ssh/authorized_keys",
-            ],
-            capture_output=True,
-            timeout=5,
-        )
+        logger.info("Successfully created user '%s' on %s", username, vm_hostname)
+        return True
 
-        # 5. Set correct permissions
-        subprocess.run(
-            [
-                "docker",
-                "exec",
-                vm_hostname,
-                "chown",
-                "-R",
-                f"{username}:{username}",
-                f"/home/{username}/.ssh",
-            ],
-            capture_output=True,
-            timeout=5,
-        )
+    except Exception as e:
+        logger.error("Error creating user on %s: %s", vm_hostname, e)
+        return False
 
-        subprocess.run(
-            ["docker", "exec", vm_hostname, "chmod", "700", f"/home/{username}/.ssh"],
-            capture_output=True,
-            timeout=5,
-        )
 
-        subprocess.run(
-            [
-                "docker",
-                "exec",
-                vm_hostname,
-                "chmod",
-                "600",
-                f"/home/{username}/.ssh/authorized_keys",
-            ],
-            capture_output=True,
-            timeout=5,
-        )
+# Provisioning runs on a dedicated pool so the dockerd round-trips don't
+# occupy the request worker; socket I/O in the SDK releases the GIL
+_PROVISION_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="provision")
 
-        logger.info(f"Successfully created user '{username}' on {vm_hostname}")
-        return True
 
-    except Exception as e:
-        logger.error(f"Error creating user on {vm_hostname}: {e}")
-        return False
+def ensure_user_on_vm(vm_hostname, username):
+    """
+    Make sure the user account exists on the backend VM, creating it via
+    the provisioning pool if necessary. Returns True if the user exists.
+    """
+    if user_exists_on_vm(vm_hostname, username):
+        return True
+    future = _PROVISION_POOL.submit(create_user_on_vm, vm_hostname, username)
+    return future.result(timeout=15)
 
 
-def determine_target_backend(username, users_map):
+def determine_target_backend(username, users_index):
     """
     Determine which backend VM to route user to
     Returns (vm_hostname, port)
     """
-    # Check explicit mapping first
-    if username in users_map:
-        user_config = users_map[username]
-        target_vm = user_config.get("backend", "backend_vm1")
-        target_port = user_config.get("port", 22)
-        logger.info(f"Explicit mapping: {username} -> {target_vm}:{target_port}")
+    # Check explicit mapping first (single lookup, tuple unpack)
+    entry = users_index.get(username)
+    if entry is not None:
+        target_vm, target_port, _ = entry
+        logger.info("Explicit mapping: %s -> %s:%s", username, target_vm, target_port)
         return target_vm, target_port
 
-    # Pattern-based routing
-    if username.startswith("admin") or username.startswith("ops"):
-        target_vm = "backend_vm1"
-    elif username.startswith("dev") or username.startswith("test"):
-        target_vm = "backend_vm2"
-    else:
-        # Default routing
-        target_vm = "backend_vm1"
+    # Pattern-based routing (default: vm1)
+    m = _ROUTE_RE.match(username)
+    target_vm = "vm2" if m and m.group("vm2") else "vm1"
 
-    logger.info(f"Pattern-based routing: {username} -> {target_vm}:22")
+    logger.info("Pattern-based routing: %s -> %s:22", username, target_vm)
     return target_vm, 22
 
 
 @app.route("/config", methods=["POST"])
+@cache.cached(timeout=30, make_cache_key=make_cache_key)
 def config():
     """
     ContainerSSH configuration endpoint
     Extracts username from OAuth email, auto-provisions user, returns backend config
     """
     try:
-        payload = request.get_json(force=True)
+        payload = orjson.loads(request.get_data())
 
         # Log full payload for debugging
-        logger.debug(
-            f"Received config request payload: {json.dumps(payload, indent=2)}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received config request payload: %s", json.dumps(payload, indent=2)
+            )
 
         # Extract email from OAuth metadata
         # ContainerSSH passes OAuth claims in metadata field
@@ -247,29 +441,28 @@ def config():
 
         # username = extract_username_from_email(email)
         if not username:
-            logger.error(f"Failed to extract username from email: {email}")
-            return jsonify({"success": False, "error": "Invalid email format"}), 400
+            logger.error("Failed to extract username from email: %s", email)
+            return json_response(
+                {"success": False, "error": "Invalid email format"}, 400
+            )
 
         logger.info(
-            f"Config request for email: {email}, extracted username: {username}"
+            "Config request for email: %s, extracted username: %s", email, username
         )
 
         # Load user mappings
-        users_map = load_users_map()
+        users_index = load_users_index()
 
         # Determine target backend
-        target_vm, target_port = determine_target_backend(username, users_map)
-
-        # # Check if user exists on target VM, create if not
-        # if not user_exists_on_vm(target_vm, username):
-        #     logger.info(f"User '{username}' does not exist on {target_vm}, creating...")
-        #     if not create_user_on_vm(target_vm, username):
-        #         return jsonify({
-        #             "success": False,
-        #             "error": f"Failed to create user on {target_vm}"
-        #         }), 500
-        # else:
-        #     logger.info(f"User '{username}' already exists on {target_vm}")
+        target_vm, target_port = determine_target_backend(username, users_index)
+
+        # # Check if user exists on target VM, create if not (provisioning
+        # # runs on the dedicated pool, off the request worker)
+        # if not ensure_user_on_vm(target_vm, username):
+        #     return json_response(
+        #         {"success": False, "error": f"Failed to create user on {target_vm}"},
+        #         500,
+        #     )
 
         # Return SSH backend configuration
         config_response = {
@@ -287,18 +480,71 @@ def config():
             }
         }
 
-        logger.info(f"Returning config for {username} -> {target_vm}:{target_port}")
-        return jsonify(config_response), 200
+        logger.info(
+            "Returning config for %s -> %s:%s", username, target_vm, target_port
+        )
+        return json_response(config_response)
+
+    except Exception as e:
+        logger.error("Error processing config request: %s", e, exc_info=True)
+        return json_response({"success": False, "error": str(e)}, 500)
+
+
+def authorized_key_blobs(user_config):
+    """Normalize a user's authorized_keys into a set of base64 key blobs"""
+    blobs = set()
+    for line in user_config.get("authorized_keys", []):
+        parts = line.split()
+        if len(parts) >= 2:
+            blobs.add(parts[1])
+    return frozenset(blobs)
+
+
+@app.route("/pubkey", methods=["POST"])
+@cache.cached(timeout=30, make_cache_key=make_cache_key)
+def pubkey():
+    """
+    ContainerSSH public key authentication endpoint
+    Validates the submitted key against the user's authorized_keys by
+    comparing the base64 key blob (the middle token of the key line)
+    """
+    try:
+        payload = orjson.loads(request.get_data())
+        username = payload.get("username", "")
+        public_key = payload.get("publicKey", "")
+
+        # Malformed keys have no blob token and are rejected cleanly
+        parts = public_key.split()
+        submitted_blob = parts[1] if len(parts) >= 2 else None
+
+        entry = load_users_index().get(username)
+
+        if (
+            entry is not None
+            and submitted_blob is not None
+            and submitted_blob in entry[2]
+        ):
+            logger.info("Public key accepted for '%s'", username)
+            return json_response({"success": True, "authenticatedUsername": username})
+
+        logger.info("Public key rejected for '%s'", username)
+        return json_response({"success": False}, 403)
 
     except Exception as e:
-        logger.error(f"Error processing config request: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+        logger.error("Error processing pubkey request: %s", e, exc_info=True)
+        return json_response({"success": False, "error": str(e)}, 500)
+
+
+# Health responses never change, so serialize once and reuse the Response
+_HEALTH_RESPONSE = app.response_class(
+    b'{"status":"healthy"}\n', status=200, mimetype="application/json"
+)
 
 
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "healthy"}), 200
+    return _HEALTH_RESPONSE
 
 
 if __name__ == "__main__":
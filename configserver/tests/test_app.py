@@ -7,13 +7,13 @@ import unittest
 import json
 import tempfile
 import os
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, mock_open, Mock
 import sys
 
 # Add parent directory to path to import app
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import app, load_users_map
+from app import app, cache, load_users_map
 
 
 class ConfigServerTestCase(unittest.TestCase):
@@ -24,6 +24,7 @@ class ConfigServerTestCase(unittest.TestCase):
         self.app = app
         self.app.config['TESTING'] = True
         self.client = self.app.test_client()
+        cache.clear()
 
     def test_health_endpoint(self):
         """Test health check endpoint"""
@@ -160,26 +161,49 @@ class ConfigServerTestCase(unittest.TestCase):
 class LoadUsersMapTestCase(unittest.TestCase):
     """Test cases for load_users_map function"""
 
+    def setUp(self):
+        """Reset the module-level cache between tests"""
+        import app
+        app._USERS_CACHE.update(
+            {"mtime": None, "size": None, "data": {}, "index": app._EMPTY_INDEX}
+        )
+
     @patch('builtins.open', new_callable=mock_open, read_data='{"alice": {"backend": "vm1"}}')
-    @patch('os.path.exists', return_value=True)
-    def test_load_users_map_success(self, mock_exists, mock_file):
+    @patch('os.stat', return_value=Mock(st_mtime_ns=1, st_size=29))
+    def test_load_users_map_success(self, mock_stat, mock_file):
         """Test successful loading of users map"""
         result = load_users_map()
         self.assertEqual(result, {'alice': {'backend': 'vm1'}})
 
-    @patch('os.path.exists', return_value=False)
-    def test_load_users_map_file_not_exists(self, mock_exists):
+    @patch('os.stat', side_effect=FileNotFoundError)
+    def test_load_users_map_file_not_exists(self, mock_stat):
         """Test loading users map when file doesn't exist"""
         result = load_users_map()
         self.assertEqual(result, {})
 
     @patch('builtins.open', side_effect=Exception('Test error'))
-    @patch('os.path.exists', return_value=True)
-    def test_load_users_map_error(self, mock_exists, mock_file):
+    @patch('os.stat', return_value=Mock(st_mtime_ns=1, st_size=29))
+    def test_load_users_map_error(self, mock_stat, mock_file):
         """Test loading users map with error"""
         result = load_users_map()
         self.assertEqual(result, {})
 
+    @patch('builtins.open', new_callable=mock_open, read_data='{"alice": "vm9"}')
+    @patch('os.stat', return_value=Mock(st_mtime_ns=1, st_size=16))
+    def test_load_users_map_malformed_shape(self, mock_stat, mock_file):
+        """Test loading users map whose entries aren't objects"""
+        result = load_users_map()
+        self.assertEqual(result, {})
+
+    @patch('builtins.open', new_callable=mock_open, read_data='{"alice": {"backend": "vm1"}}')
+    @patch('os.stat', return_value=Mock(st_mtime_ns=1, st_size=29))
+    def test_load_users_map_cached_until_file_changes(self, mock_stat, mock_file):
+        """Test that an unchanged file is not re-read on subsequent calls"""
+        first = load_users_map()
+        second = load_users_map()
+        self.assertIs(first, second)
+        mock_file.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()